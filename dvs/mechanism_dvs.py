@@ -24,6 +24,11 @@
 import time
 import threading
 import random
+import signal
+import itertools
+import collections
+import heapq
+import Queue
 
 from oslo.config import cfg
 
@@ -31,14 +36,11 @@ from neutron.common import exceptions
 from neutron.openstack.common import log as logging
 from neutron.plugins.ml2 import driver_api as api
 
-from pyVim.connect import SmartConnect as SmartConnect
-from pyVim.connect import Disconnect as Disconnect
-from pyVmomi import vim, vmodl
-
 
 LOG = logging.getLogger(__name__)
 MECHANISM_VERSION = 0.42
 NET_TYPES_SUPPORTED = ('vlan',)
+TODO_ENGINES = ('threaded', 'pipeline')
 
 
 # Do some test fuzzing in worker thread?
@@ -50,6 +52,32 @@ TEST_FUZZ_WORKER_BLOCK = 2.0
 TEST_FUZZ_DISCONNECT = 0.98
 
 
+# pyVmomi is loaded lazily by _load_pyvmomi() from the warm-up thread,
+# so that loading the driver does not depend on it.
+SmartConnect = None
+Disconnect = None
+vim = None
+vmodl = None
+
+
+def _load_pyvmomi():
+    """Import pyVmomi modules on first use"""
+    global SmartConnect, Disconnect, vim, vmodl
+
+    if vim is not None:
+        return
+
+    from pyVim.connect import SmartConnect as _SmartConnect
+    from pyVim.connect import Disconnect as _Disconnect
+    from pyVmomi import vim as _vim, vmodl as _vmodl
+
+    SmartConnect = _SmartConnect
+    Disconnect = _Disconnect
+    vmodl = _vmodl
+    # Set last, it is the "already loaded" marker above
+    vim = _vim
+
+
 ML2_DVS = [
     cfg.StrOpt('vsphere_server', default='127.0.0.1',
                help=_('The server hostname or IP address'
@@ -74,6 +102,13 @@ ML2_DVS = [
     cfg.StrOpt('portgroup_prefix', default='',
                help=_('The prefix to prepend to port group names in vSphere')),
 
+    cfg.IntOpt('init_retry_interval', default=10,
+               help=_('How long to wait before retrying vSphere login'
+                      ' and dvSwitch warm-up after a failure')),
+    cfg.IntOpt('init_ready_timeout', default=5,
+               help=_('How long port creation waits for the driver'
+                      ' to become ready before failing')),
+
     cfg.IntOpt('todo_loop_interval', default=2,
                help=_('How often to poll TODO list for'
                       ' doable or expired work')),
@@ -88,6 +123,30 @@ ML2_DVS = [
     cfg.IntOpt('todo_vsphere_keepalive', default=300,
                help=_('How often to ask vSphere server for timestamp'
                       ' in order to keep login session alive')),
+
+    cfg.StrOpt('todo_engine', default='threaded',
+               help=_('How to run the TODO list: "threaded" polls it'
+                      ' from a worker thread, "pipeline" runs it on an'
+                      ' event loop with a bounded vSphere call executor')),
+    cfg.IntOpt('todo_executor_size', default=4,
+               help=_('How many vSphere calls the pipeline engine'
+                      ' may run concurrently')),
+    cfg.IntOpt('todo_task_polling_interval', default=2,
+               help=_('How often the pipeline engine checks a pending'
+                      ' vSphere reconfigure task')),
+    cfg.IntOpt('todo_call_timeout', default=120,
+               help=_('How long the pipeline engine waits for a single'
+                      ' vSphere call before replacing its executor')),
+    cfg.IntOpt('todo_reconfigure_attempts', default=5,
+               help=_('How many times the pipeline engine reconfigures'
+                      ' a particular VM before giving up')),
+
+    cfg.IntOpt('trace_buffer_size', default=4096,
+               help=_('How many todo task lifecycle events to keep'
+                      ' in the in-memory trace buffer')),
+    cfg.StrOpt('trace_dump_signal', default='',
+               help=_('Signal name, e.g. SIGUSR2, which dumps the trace'
+                      ' buffer to the log. Empty disables dumping.')),
 ]
 cfg.CONF.register_opts(ML2_DVS, "ml2_dvs")
 
@@ -100,41 +159,82 @@ class DvsRuntimeError(exceptions.NeutronException):
 
 
 
+class TraceBuffer():
+    """In-memory ring buffer of todo task lifecycle events"""
+
+    def __init__(self, size):
+        # deque.append() is atomic, so recording needs no lock
+        self.events = collections.deque(maxlen=max(size, 0))
+
+    def record(self, trace_id, event, detail=None, duration=None):
+        self.events.append((time.time(), trace_id, event, detail, duration))
+
+    def dump(self):
+        events = list(self.events)
+        LOG.warn(_("dvs trace dump: %d events"), len(events))
+        for (ts, trace_id, event, detail, duration) in events:
+            if duration is None:
+                LOG.warn(_("trace %.3f #%d %s %s"),
+                         ts, trace_id, event, detail)
+            else:
+                LOG.warn(_("trace %.3f #%d %s %s (%.3f s)"),
+                         ts, trace_id, event, detail, duration)
+        return self
+
+
 TODO_CLASS_DEFAULT_EXPIRE = 300
 
+# Shared by all todo entries, next() on it is atomic
+_trace_ids = itertools.count(1)
+
 class TodoEntry():
     def __init__(self, item, starttime=None, expiretime=None):
         if not starttime: starttime = time.time()
         if not expiretime: expiretime = starttime + TODO_CLASS_DEFAULT_EXPIRE
 
+        self.trace_id = next(_trace_ids)
+        self.createtime = time.time()
         self.starttime = starttime
         self.expiretime = expiretime
         self.done = False
+        self.reconfigures = 0
         self.item = item
 
+    def __repr__(self):
+        return "<TodoEntry #%d %r>" % (self.trace_id, self.item)
+
 
 class TodoList():
-    def __init__(self):
+    def __init__(self, trace=None):
         self.todo = []
         self.lock = threading.Lock()
+        if trace is None: trace = TraceBuffer(0)
+        self.trace = trace
 
     def _cleanup(self, now=None):
         if not now: now = time.time()
         with self.lock:
-            for entry in self.todo:
+            # Iterate over a copy, removing from the list being looped
+            # over would skip the entry after each removed one.
+            for entry in list(self.todo):
                 if entry.done:
                     self.todo.remove(entry)
-                if now >= entry.expiretime:
-                    LOG.warn(_("Expired todo task: %s" % repr(entry)))
+                elif now >= entry.expiretime:
+                    LOG.warn(_("Expired todo task: %r"), entry)
+                    self.trace.record(entry.trace_id, "expire",
+                                      duration=now - entry.createtime)
                     self.todo.remove(entry)
         return self
 
     def add(self, item, starttime, expiretime):
         now = time.time()
-        LOG.info(_("todo add item=%s now=%d starttime-delta %d expire-delta %d"
-                   % (repr(item), now, starttime-now, expiretime-now)))
-
         entry = TodoEntry(item, starttime=starttime, expiretime=expiretime)
+        LOG.info(_("todo add #%d item=%r now=%d"
+                   " starttime-delta %d expire-delta %d"),
+                 entry.trace_id, item, now,
+                 starttime-now, expiretime-now)
+        self.trace.record(entry.trace_id, "enqueue", item)
+
         with self.lock:
             self.todo.append(entry)
         return self
@@ -150,6 +250,357 @@ class TodoList():
         return tuple(doable_list)
 
 
+class TodoPipelineEngine():
+    """Event loop running todo entries through the connect pipeline.
+
+    One loop thread schedules the stages lookup, fetch devices,
+    reconfigure and await task. The blocking vSphere calls of each stage
+    run on a bounded pool of executor threads, which hand their results
+    back to the loop through the thread safe inbox queue. Calls running
+    longer than call_timeout are given up and their executor replaced,
+    up to 2 * executor_size threads including the abandoned ones.
+    """
+
+    def __init__(self, driver, executor_size, task_polling_interval,
+                 call_timeout, reconfigure_attempts):
+        self.driver = driver
+        self.trace = driver.trace
+        self.executor_size = executor_size
+        self.task_polling_interval = task_polling_interval
+        self.call_timeout = call_timeout
+        self.reconfigure_attempts = reconfigure_attempts
+
+        # (callback, args, entry) for the loop thread, put by any thread
+        self.inbox = Queue.Queue()
+        # (entry, func, args, callback, cbargs) for the executor threads
+        self.calls = Queue.Queue()
+        # heap of (when, seq, callback, args, entry), loop thread only
+        self.timers = []
+        self.timer_seq = itertools.count()
+
+        # executor id -> (starttime, call) of the call it is running
+        self.busy = {}
+        self.busy_lock = threading.Lock()
+        self.executor_ids = itertools.count()
+        # Executor threads in the pool, and all of them including
+        # the abandoned ones still stuck in a call. Under busy_lock.
+        self.executors_live = 0
+        self.executors_total = 0
+        self.executors_max = 2 * executor_size
+
+        self.keepalive_last = 0
+        self.housekeeping_busy = False
+        # No housekeeping before this, set after a hung housekeeping call
+        self.housekeeping_holdoff = 0
+
+    def start(self):
+        for i in range(self.executor_size):
+            self._start_executor()
+
+        self.loop = threading.Thread(target=self._loop,
+                                     name="ml2_mech_dvs_loop")
+        self.loop.daemon = True
+        self.loop.start()
+        self.inbox.put((self._housekeeping, (), None))
+        LOG.info(_("Pipeline engine started: %d executors"),
+                 self.executor_size)
+        return self
+
+    def submit(self, entry):
+        """Hand a todo entry to the loop, safe to call from any thread"""
+        now = time.time()
+        LOG.info(_("todo add #%d item=%r now=%d"
+                   " starttime-delta %d expire-delta %d"),
+                 entry.trace_id, entry.item, now,
+                 entry.starttime-now, entry.expiretime-now)
+        self.trace.record(entry.trace_id, "enqueue", entry.item)
+        self.inbox.put((self._schedule, (entry,), entry))
+        return self
+
+    # Loop machinery
+
+    def _loop(self):
+        while True:
+            now = time.time()
+            timeout = self.driver.todo_loop_interval
+            if self.timers:
+                timeout = max(min(timeout, self.timers[0][0] - now), 0)
+
+            try:
+                (callback, args, entry) = self.inbox.get(timeout=timeout)
+                self._dispatch(callback, args, entry)
+            except Queue.Empty:
+                pass
+
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                (when, seq, callback, args, entry) = heapq.heappop(self.timers)
+                self._dispatch(callback, args, entry)
+
+    def _dispatch(self, callback, args, entry):
+        # The loop thread must survive any bug in a stage,
+        # and the entry must not get lost with it.
+        try:
+            callback(*args)
+        except Exception as error:
+            msg = (_("Pipeline stage %(cb)s failed: %(err)s") %
+                   {'cb': callback.__name__, 'err': error})
+            LOG.exception(msg)
+            if entry is not None:
+                self._retry(entry)
+
+    def _call_later(self, delay, entry, callback, *args):
+        heapq.heappush(self.timers, (time.time() + delay,
+                                     next(self.timer_seq),
+                                     callback, args, entry))
+
+    def _run_in_executor(self, entry, func, args, callback, *cbargs):
+        """Run func(*args) on an executor thread, then
+        callback(result, error, duration, *cbargs) on the loop thread"""
+        if self._congested():
+            # Do not queue more calls behind hung ones, fail them instead
+            msg = (_("vSphere calls hung, %d executor threads in use") %
+                   self.executors_max)
+            self.inbox.put((callback,
+                            (None, DvsRuntimeError(msg=msg), 0) + cbargs,
+                            entry))
+            return
+        self.calls.put((entry, func, args, callback, cbargs))
+
+    def _congested(self):
+        """Thread limit reached and every executor is stuck in a call"""
+        with self.busy_lock:
+            return (self.executors_total >= self.executors_max and
+                    self.executors_live < 1)
+
+    def _start_executor(self):
+        with self.busy_lock:
+            if self.executors_total >= self.executors_max:
+                return False
+            self.executors_live += 1
+            self.executors_total += 1
+        ident = next(self.executor_ids)
+        t = threading.Thread(target=self._executor, args=(ident,),
+                             name="ml2_mech_dvs_executor_%d" % ident)
+        t.daemon = True
+        t.start()
+        return True
+
+    def _executor(self, ident):
+        while True:
+            call = self.calls.get()
+            (entry, func, args, callback, cbargs) = call
+            result = None
+            error = None
+            t0 = time.time()
+            with self.busy_lock:
+                self.busy[ident] = (t0, call)
+            try:
+                result = func(*args)
+            except Exception as err:
+                error = err
+
+            with self.busy_lock:
+                if self.busy.pop(ident, None) is None:
+                    # Given up by _check_executors. Rejoin the pool if it
+                    # could not be replaced, otherwise stop.
+                    if self.executors_live < self.executor_size:
+                        self.executors_live += 1
+                        LOG.info(_("abandoned executor %d rejoining"), ident)
+                        continue
+                    self.executors_total -= 1
+                    LOG.info(_("abandoned executor %d stopping"), ident)
+                    return None
+            self.inbox.put((callback,
+                            (result, error, time.time() - t0) + cbargs,
+                            entry))
+
+    def _check_executors(self):
+        """Give up calls past their deadline and replace their executors"""
+        now = time.time()
+        stuck = []
+        with self.busy_lock:
+            for (ident, (t0, call)) in list(self.busy.items()):
+                if now > t0 + self.call_timeout:
+                    del self.busy[ident]
+                    self.executors_live -= 1
+                    stuck.append((t0, call))
+
+        for (t0, (entry, func, args, callback, cbargs)) in stuck:
+            msg = (_("vSphere call %(func)s hung for %(sec)d seconds") %
+                   {'func': func.__name__, 'sec': now - t0})
+            LOG.warn(msg)
+            if not self._start_executor():
+                LOG.warn(_("Executor thread limit %d reached,"
+                           " not replacing hung executor"),
+                         self.executors_max)
+            if func == self._check_vsphere:
+                # Back off instead of hanging another executor right away
+                self.housekeeping_holdoff = now + self.call_timeout
+            self._dispatch(callback,
+                           (None, DvsRuntimeError(msg=msg), now - t0) + cbargs,
+                           entry)
+
+    # Housekeeping, the pipeline equivalent of the worker loop checks
+
+    def _housekeeping(self):
+        self._call_later(self.driver.todo_loop_interval, None,
+                         self._housekeeping)
+        self._check_executors()
+        if self.housekeeping_busy or not self.driver.ready.is_set():
+            return
+        if time.time() < self.housekeeping_holdoff or self._congested():
+            return
+        self.housekeeping_busy = True
+        self._run_in_executor(None, self._check_vsphere, (),
+                              self._on_housekeeping)
+
+    def _check_vsphere(self):
+        now = time.time()
+        if now > self.keepalive_last + self.driver.todo_vsphere_keepalive:
+            self.driver._check_si()
+            self.keepalive_last = now
+        self.driver._check_dvs()
+
+    def _on_housekeeping(self, result, error, duration):
+        self.housekeeping_busy = False
+        if error:
+            LOG.info(_("Pipeline housekeeping failed: %s"), error)
+
+    # Pipeline stages, all run on the loop thread
+
+    def _schedule(self, entry):
+        self._call_later(entry.starttime - time.time(), entry,
+                         self._lookup, entry)
+
+    def _retry(self, entry):
+        entry.starttime = time.time() + self.driver.todo_polling_interval
+        self._schedule(entry)
+
+    def _expired(self, entry):
+        now = time.time()
+        if now < entry.expiretime:
+            return False
+        LOG.warn(_("Expired todo task: %r"), entry)
+        self.trace.record(entry.trace_id, "expire",
+                          duration=now - entry.createtime)
+        return True
+
+    def _done(self, entry):
+        entry.done = True
+        self.trace.record(entry.trace_id, "done",
+                          duration=time.time() - entry.createtime)
+
+    def _lookup(self, entry):
+        if self._expired(entry):
+            return
+        if not self.driver.ready.is_set():
+            return self._retry(entry)
+
+        self._run_in_executor(entry, self.driver._find_vm, (entry.item[0],),
+                              self._on_lookup, entry)
+
+    def _on_lookup(self, myvm, error, duration, entry):
+        if error:
+            self.trace.record(entry.trace_id, "lookup-error", error, duration)
+            LOG.info(_("*** _find_vm(%s) failed: %s"), entry.item[0], error)
+            return self._retry(entry)
+
+        self.trace.record(entry.trace_id, "lookup", bool(myvm), duration)
+        if not myvm:
+            return self._retry(entry)
+
+        self._run_in_executor(entry, self.driver._vm_nics, (myvm,),
+                              self._on_devices, entry, myvm)
+
+    def _on_devices(self, nic, error, duration, entry, myvm):
+        (vm_uuid, pg_name) = entry.item
+        if error:
+            self.trace.record(entry.trace_id, "devices-error", error,
+                              duration)
+            LOG.info(_("*** VM %s device enumeration failed: %s"),
+                     vm_uuid, error)
+            return self._retry(entry)
+
+        self.trace.record(entry.trace_id, "devices", len(nic), duration)
+        if not nic:
+            LOG.info(_("WARNING: VM %s has no nics"), vm_uuid)
+            return self._retry(entry)
+
+        # NOTE: currently we support only nic0 connections
+        if len(nic) > 1: LOG.info(_("WARNING: VM %s has %d nics"),
+                                  vm_uuid, len(nic))
+
+        if self.driver._nic_on_portgroup(nic[0], pg_name):
+            self.trace.record(entry.trace_id, "verify", "ok")
+            LOG.info(_("*** VM %s nic0 port group OK. Task complete."),
+                     vm_uuid)
+            return self._done(entry)
+
+        self.trace.record(entry.trace_id, "verify", "mismatch")
+        if self._expired(entry):
+            return
+        if entry.reconfigures >= self.reconfigure_attempts:
+            LOG.warn(_("Giving up todo task %r after %d reconfigures"),
+                     entry, entry.reconfigures)
+            self.trace.record(entry.trace_id, "expire", "reconfigures",
+                              time.time() - entry.createtime)
+            return
+
+        entry.reconfigures += 1
+        LOG.info(_("*** Changing VM %s nic0 port group to %s"),
+                 vm_uuid, pg_name)
+        self._run_in_executor(entry, self._reconfigure,
+                              (myvm, nic[0], pg_name),
+                              self._on_reconfigure, entry, myvm)
+
+    def _reconfigure(self, myvm, nic, pg_name):
+        return myvm.Reconfigure(self.driver._nic_config_spec(nic, pg_name))
+
+    def _on_reconfigure(self, task, error, duration, entry, myvm):
+        if error:
+            self.trace.record(entry.trace_id, "reconfigure-error", error,
+                              duration)
+            LOG.info(_("*** Error: VM %s Reconfiguration failed: %s"),
+                     entry.item[0], error)
+            return self._retry(entry)
+
+        self.trace.record(entry.trace_id, "reconfigure", entry.item[1],
+                          duration)
+        self._call_later(self.task_polling_interval, entry, self._poll_task,
+                         entry, myvm, task, time.time())
+
+    def _poll_task(self, entry, myvm, task, t0):
+        self._run_in_executor(entry, self._task_state, (task,),
+                              self._on_task_state, entry, myvm, task, t0)
+
+    def _task_state(self, task):
+        info = task.info
+        return (info.state, info.error)
+
+    def _on_task_state(self, state, error, duration, entry, myvm, task, t0):
+        if error:
+            self.trace.record(entry.trace_id, "task-error", error, duration)
+            return self._retry(entry)
+
+        (state, task_error) = state
+        if state in ('queued', 'running'):
+            if self._expired(entry):
+                return
+            return self._call_later(self.task_polling_interval, entry,
+                                    self._poll_task, entry, myvm, task, t0)
+
+        self.trace.record(entry.trace_id, "task", state, time.time() - t0)
+        if not state == 'success':
+            LOG.info(_("*** Error: VM %s Reconfigure task %s: %s"),
+                     entry.item[0], state, task_error)
+            return self._retry(entry)
+
+        # Do not blindly trust the task, verify nic0 once more
+        self._run_in_executor(entry, self.driver._vm_nics, (myvm,),
+                              self._on_devices, entry, myvm)
+
+
 class VmwareDvswitchMechanismDriver(api.MechanismDriver):
     """ML2 Mechanism driver for VMWare dvSwitches"""
 
@@ -171,11 +622,49 @@ class VmwareDvswitchMechanismDriver(api.MechanismDriver):
             self.todo_polling_interval = int(cfg.CONF.ml2_dvs.todo_polling_interval)
             self.todo_expire_time = int(cfg.CONF.ml2_dvs.todo_expire_time)
             self.todo_vsphere_keepalive = int(cfg.CONF.ml2_dvs.todo_vsphere_keepalive)
+            self.init_retry_interval = int(cfg.CONF.ml2_dvs.init_retry_interval)
+            self.init_ready_timeout = int(cfg.CONF.ml2_dvs.init_ready_timeout)
+            self.trace_buffer_size = int(cfg.CONF.ml2_dvs.trace_buffer_size)
+            self.trace_dump_signal = cfg.CONF.ml2_dvs.trace_dump_signal
+            self.todo_engine = cfg.CONF.ml2_dvs.todo_engine
+            self.todo_executor_size = int(cfg.CONF.ml2_dvs.todo_executor_size)
+            self.todo_task_polling_interval = int(cfg.CONF.ml2_dvs.todo_task_polling_interval)
+            self.todo_call_timeout = int(cfg.CONF.ml2_dvs.todo_call_timeout)
+            self.todo_reconfigure_attempts = int(cfg.CONF.ml2_dvs.todo_reconfigure_attempts)
+
+            if not self.todo_engine in TODO_ENGINES:
+                raise ValueError(_("Unsupported todo_engine \"%s\"") %
+                                 self.todo_engine)
+            if self.todo_executor_size < 1:
+                raise ValueError(_("todo_executor_size must be at least 1"))
 
             self.si_lock = threading.Lock()
             self.dvs_lock = threading.Lock()
             self.si = None
-            self.todo = TodoList()
+            self.trace = TraceBuffer(self.trace_buffer_size)
+            self.todo = TodoList(trace=self.trace)
+            self.engine = None
+            if self.todo_engine == 'pipeline':
+                self.engine = TodoPipelineEngine(
+                    self, self.todo_executor_size,
+                    self.todo_task_polling_interval,
+                    self.todo_call_timeout,
+                    self.todo_reconfigure_attempts)
+
+            # Empty cache until the warm-up thread has filled it
+            self.dvs_uuid = None
+            self.pg_key = {}
+            self.pg_name = {}
+            self.pg_ts = 0
+
+            # Set by the warm-up thread after the first successful
+            # vSphere login and dvSwitch update
+            self.ready = threading.Event()
+            # Set by the warm-up thread if the driver can never get ready
+            self.init_error = None
+            self.warmup = threading.Thread(target=self._warmup,
+                                           name="ml2_mech_dvs_warmup")
+            self.warmup.daemon = True
 
             self.worker_local = threading.local()
             self.watchdog = threading.Thread(target=self._todo_watchdog,
@@ -196,16 +685,95 @@ class VmwareDvswitchMechanismDriver(api.MechanismDriver):
     def initialize(self):
         LOG.info(_("ML2 vmware dvswitch mech driver initializing"))
         now = time.time()
-        self._init_si()
-        self._update_dvs()
-        self.pg_ts = now 
-        self._start_worker(now)
-        self.watchdog.start()
-        LOG.info(_("dvs driver initialized: dvs_name=%s dvs_refresh=%d" %
-                   (self.dvs_name, self.dvs_refresh_interval)))
+        # vSphere login and dvswitch update happen in the background,
+        # neutron-server startup must not wait for vSphere.
+        self.warmup.start()
+        if self.engine:
+            self.engine.start()
+        else:
+            self._start_worker(now)
+            self.watchdog.start()
+        self._init_trace_signal()
+        LOG.info(_("dvs driver initialized: dvs_name=%s dvs_refresh=%d"
+                   " todo_engine=%s" %
+                   (self.dvs_name, self.dvs_refresh_interval,
+                    self.todo_engine)))
+        return self
+
+
+    def _init_trace_signal(self):
+        if not self.trace_dump_signal:
+            return self
+
+        try:
+            signum = getattr(signal, self.trace_dump_signal)
+            signal.signal(signum, self._dump_trace)
+        except Exception as error:
+            # Unknown signal name, or not called from the main thread
+            msg = (_("Could not install trace dump signal %(sig)s:"
+                     " %(err)s") %
+                   {'sig': self.trace_dump_signal, 'err': error})
+            LOG.warn(msg)
         return self
 
 
+    def _dump_trace(self, signum=None, frame=None):
+        """Dump todo task lifecycle trace to the log"""
+        self.trace.dump()
+
+
+    def _warmup(self):
+        """Login to vsphere and fill dvswitch cache, retry until success"""
+
+        LOG.info(_("warm-up thread started"))
+
+        try:
+            _load_pyvmomi()
+        except ImportError as error:
+            # Retrying will not install pyVmomi
+            self.init_error = (_("Could not load pyVmomi, dvs driver"
+                                 " disabled: %(err)s") % {'err': error})
+            LOG.error(self.init_error)
+            return None
+
+        LOG.info(_("CONNECT - proto %s server %s port %d path %s"
+                   " user %s dvs_name %s") %
+                 (self.vsphere_proto, self.vsphere_server,
+                  self.vsphere_port, self.vsphere_path,
+                  self.vsphere_user, self.dvs_name))
+
+        while True:
+            try:
+                now = time.time()
+                if self.si is not None:
+                    # Reuse the session of an earlier attempt, if it lives,
+                    # so that retries do not pile up vSphere sessions.
+                    try:
+                        self.si.CurrentTime()
+                    except Exception:
+                        self.si = None
+                if self.si is None:
+                    # Quiet, the single warning below is enough per attempt
+                    self._init_si(quiet=True)
+                # Someone else may hold the si lock, check the result
+                if self.si:
+                    self._update_dvs(quiet=True)
+                    self.pg_ts = now
+                    break
+
+            except Exception as error:
+                msg = (_("dvs warm-up failed, retrying in %(sec)d seconds:"
+                         " %(err)s") %
+                       {'sec': self.init_retry_interval, 'err': error})
+                LOG.warn(msg)
+
+            time.sleep(self.init_retry_interval)
+
+        self.ready.set()
+        LOG.info(_("dvs driver ready: %d port groups cached" %
+                   len(self.pg_key)))
+
+
     def _start_worker(self, now):
         self.todo_watchdog = now
         self.worker = threading.Thread(target=self._todo_worker,
@@ -273,6 +841,9 @@ class VmwareDvswitchMechanismDriver(api.MechanismDriver):
             # Update watchdog timestamp
             self.todo_watchdog = now
 
+            # Nothing to do before the warm-up has finished
+            if not self.ready.is_set(): continue
+
             # Test and keep vsphere session alive
             if now > keepalive_last + self.todo_vsphere_keepalive:
                 self._check_si()
@@ -283,19 +854,23 @@ class VmwareDvswitchMechanismDriver(api.MechanismDriver):
 
             # Check my work list
             tasks = self.todo.get_tasks()
-            if tasks: LOG.info(_("Worker %d found %d doable tasks" %
-                                 (self.worker_local.thread_id, len(tasks))))
+            if tasks: LOG.debug(_("Worker %d found %d doable tasks"),
+                                self.worker_local.thread_id, len(tasks))
 
             # Do the needful
             for entry in tasks:
                 if not self._todo_eligible(): return None
 
-                LOG.info(_("Worker %d trying to connect vm %s to network %s") %
-                         (self.worker_local.thread_id,
-                          entry.item[0], entry.item[1]))
+                LOG.debug(_("Worker %d trying to connect vm %s"
+                            " to network %s"),
+                          self.worker_local.thread_id,
+                          entry.item[0], entry.item[1])
 
-                if self._connect_vm(entry.item[0], entry.item[1]):
+                if self._connect_vm(entry.item[0], entry.item[1],
+                                    trace_id=entry.trace_id):
                     entry.done = True
+                    self.trace.record(entry.trace_id, "done",
+                                      duration=time.time() - entry.createtime)
                 else:
                     entry.starttime = now + self.todo_polling_interval
 
@@ -348,17 +923,18 @@ class VmwareDvswitchMechanismDriver(api.MechanismDriver):
         return self
 
 
-    def _init_si(self):
+    def _init_si(self, quiet=False):
         if not self.si_lock.acquire(blocking=False):
             # Another thread must be already doing this. Bailing out.
             return self
 
         try:
-            LOG.info(_("CONNECT - proto %s server %s port %d path %s"
-                       " user %s dvs_name %s") %
-                     (self.vsphere_proto, self.vsphere_server,
-                      self.vsphere_port, self.vsphere_path,
-                      self.vsphere_user, self.dvs_name))
+            if not quiet:
+                LOG.info(_("CONNECT - proto %s server %s port %d path %s"
+                           " user %s dvs_name %s") %
+                         (self.vsphere_proto, self.vsphere_server,
+                          self.vsphere_port, self.vsphere_path,
+                          self.vsphere_user, self.dvs_name))
 
             self.si = SmartConnect(protocol=self.vsphere_proto,
                                    host=self.vsphere_server,
@@ -373,7 +949,8 @@ class VmwareDvswitchMechanismDriver(api.MechanismDriver):
             self.si_lock.release()
             msg = (_("Could not connect to vsphere server: %(err)s") %
                      {'err': error})
-            LOG.exception(msg)
+            if not quiet:
+                LOG.exception(msg)
             raise DvsRuntimeError(msg=msg)
 
         return self
@@ -416,7 +993,7 @@ class VmwareDvswitchMechanismDriver(api.MechanismDriver):
         return self
 
 
-    def _update_dvs(self):
+    def _update_dvs(self, quiet=False):
         """Update dvswitch data from vsphere"""
 
         # Should not be called from any other method than
@@ -439,7 +1016,8 @@ class VmwareDvswitchMechanismDriver(api.MechanismDriver):
 
         if not mydvs:
             msg = (_("Could not find dvs \"%s\"") % self.dvs_name)
-            LOG.exception(msg)
+            if not quiet:
+                LOG.exception(msg)
             raise DvsRuntimeError(msg=msg)
 
         pg_key = {}
@@ -468,76 +1046,119 @@ class VmwareDvswitchMechanismDriver(api.MechanismDriver):
         return myvm
 
 
-    def _connect_vm(self, vm_uuid, pg_name):
-        LOG.info(_("_connect_vm uuid %s port group %s") % (vm_uuid, pg_name))
+    def _vm_nics(self, myvm):
+        """List the ethernet cards of a VM"""
+        nic = []
+        for vd in myvm.config.hardware.device:
+            if isinstance(vd, vim.vm.device.VirtualEthernetCard):
+                nic.append(vd)
+        return nic
+
+
+    def _nic_on_portgroup(self, nic, pg_name):
+        """Is nic connected to dvswitch port group pg_name"""
+        # Standard vSwitch nics have no dvs port in their backing,
+        # and the cache may be None after a failed dvs update.
+        port = getattr(nic.backing, 'port', None)
+        key = (self.pg_key or {}).get(pg_name)
+        if port is None or key is None:
+            return False
+        return port.portgroupKey == key
+
+
+    def _nic_config_spec(self, nic, pg_name):
+        """VM config spec which moves nic to port group pg_name"""
+        conn = vim.dvs.PortConnection()
+        conn.switchUuid = self.dvs_uuid
+        conn.portgroupKey = self.pg_key[pg_name]
+        backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
+        backing.port = conn
+
+        # Create a new object of same type as nic
+        veth = type(nic)()
+        veth.key = nic.key
+
+        # MAC address has to be preserved
+        veth.addressType = 'Manual'
+        veth.macAddress = nic.macAddress
+
+        # New backing - with the desired port group
+        veth.backing = backing
+
+        vdev = vim.vm.device.VirtualDeviceSpec()
+        vdev.operation = vim.vm.device.VirtualDeviceSpec.Operation('edit')
+        vdev.device = veth
+
+        vmc = vim.vm.ConfigSpec()
+        vmc.deviceChange.append(vdev)
+        return vmc
+
+
+    def _connect_vm(self, vm_uuid, pg_name, trace_id=0):
+        LOG.debug(_("_connect_vm uuid %s port group %s"), vm_uuid, pg_name)
 
         try:
+            t0 = time.time()
             myvm = self._find_vm(vm_uuid)
+            self.trace.record(trace_id, "lookup", bool(myvm),
+                              time.time() - t0)
             if not myvm:
-                LOG.info(_("VM not found yet. Going to retry."))
+                LOG.debug(_("VM not found yet. Going to retry."))
                 return None
 
         except Exception as error:
-            LOG.info(_("*** _find_vm(%s) failed: %s") %
-                     (vm_uuid, error))
+            self.trace.record(trace_id, "lookup-error", error,
+                              time.time() - t0)
+            LOG.info(_("*** _find_vm(%s) failed: %s"), vm_uuid, error)
             return False
 
         try:
-            nic = []
-            for vd in myvm.config.hardware.device:
-                if isinstance(vd, vim.vm.device.VirtualEthernetCard):
-                    nic.append(vd)
+            t0 = time.time()
+            nic = self._vm_nics(myvm)
+            self.trace.record(trace_id, "devices", len(nic),
+                              time.time() - t0)
 
             # NOTE: currently we support only nic0 connections
-            if len(nic) > 1: LOG.info(_("WARNING: VM %s has %d nics") %
-                                      (vm_uuid, len(nic)))
+            if len(nic) > 1: LOG.info(_("WARNING: VM %s has %d nics"),
+                                      vm_uuid, len(nic))
 
         except Exception as error:
-            LOG.info(_("*** VM %s device enumeration failed: %s") %
-                     (vm_uuid, error))
+            self.trace.record(trace_id, "devices-error", error,
+                              time.time() - t0)
+            LOG.info(_("*** VM %s device enumeration failed: %s"),
+                     vm_uuid, error)
             return False
 
-        if nic[0].backing.port.portgroupKey == self.pg_key[pg_name]:
-            LOG.info(_("*** VM %s nic0 port group OK. Task complete.") %
+        if not nic:
+            LOG.info(_("WARNING: VM %s has no nics"), vm_uuid)
+            return False
+
+        if self._nic_on_portgroup(nic[0], pg_name):
+            self.trace.record(trace_id, "verify", "ok")
+            LOG.info(_("*** VM %s nic0 port group OK. Task complete."),
                      vm_uuid)
             # Connection has been successful, return True
             return True
         else:
-            LOG.info(_("*** Changing VM %s nic0 port group to %s") %
-                     (vm_uuid, pg_name))
+            self.trace.record(trace_id, "verify", "mismatch")
+            LOG.info(_("*** Changing VM %s nic0 port group to %s"),
+                     vm_uuid, pg_name)
 
             try:
-                conn = vim.dvs.PortConnection()
-                conn.switchUuid = self.dvs_uuid
-                conn.portgroupKey = self.pg_key[pg_name]
-                backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
-                backing.port = conn
-
-                # Create a new object of same type as nic[0]
-                veth = type(nic[0])()
-                veth.key = nic[0].key
-
-                # MAC address has to be preserved
-                veth.addressType = 'Manual'
-                veth.macAddress = nic[0].macAddress
+                t0 = time.time()
+                vmc = self._nic_config_spec(nic[0], pg_name)
 
-                # New backing - with the desired port group
-                veth.backing = backing
-
-                vdev = vim.vm.device.VirtualDeviceSpec()
-                vdev.operation = vim.vm.device.VirtualDeviceSpec.Operation('edit')
-                vdev.device = veth
-
-                vmc = vim.vm.ConfigSpec()
-                vmc.deviceChange.append(vdev)
-
-                LOG.info(_("*** Sending VM %s Reconfigure request.") %
+                LOG.info(_("*** Sending VM %s Reconfigure request."),
                          vm_uuid)
                 myvm.Reconfigure(vmc)
+                self.trace.record(trace_id, "reconfigure", pg_name,
+                                  time.time() - t0)
 
             except Exception as error:
-                LOG.info(_("*** Error: VM %s Reconfiguration failed: %s") %
-                         (vm_uuid, error))
+                self.trace.record(trace_id, "reconfigure-error", error,
+                                  time.time() - t0)
+                LOG.info(_("*** Error: VM %s Reconfiguration failed: %s"),
+                         vm_uuid, error)
 
             # We just TRIED to reconfigure the VM,
             # so we return False right now.
@@ -557,6 +1178,15 @@ class VmwareDvswitchMechanismDriver(api.MechanismDriver):
 
         LOG.info(_("create_port_precommit called, sanity check."))
 
+        # Wait briefly for the warm-up, then fail fast
+        if self.init_error:
+            raise DvsRuntimeError(msg=self.init_error)
+        self.ready.wait(self.init_ready_timeout)
+        if not self.ready.is_set():
+            msg = (_("dvs driver not ready, vSphere is not connected yet"))
+            LOG.error(msg)
+            raise DvsRuntimeError(msg=msg)
+
         port = mech_context.current
         net = mech_context.network.current
 
@@ -592,9 +1222,14 @@ class VmwareDvswitchMechanismDriver(api.MechanismDriver):
         # The worker thread will really handle the VM network reconfig.
         # We cannot just sit and wait here.
 
-        self.todo.add(item = (vm_uuid, mypg),
-                      starttime = now + self.todo_initial_wait,
-                      expiretime = now + self.todo_expire_time)
+        if self.engine:
+            self.engine.submit(TodoEntry(item = (vm_uuid, mypg),
+                               starttime = now + self.todo_initial_wait,
+                               expiretime = now + self.todo_expire_time))
+        else:
+            self.todo.add(item = (vm_uuid, mypg),
+                          starttime = now + self.todo_initial_wait,
+                          expiretime = now + self.todo_expire_time)
         return None
 
 
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# benchmark_engines.py
+#
+# Copyright 2014 Cybercom Finland Oy
+# All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compare the threaded and pipeline todo engines of the dvs driver.
+
+vSphere is replaced by fake calls with a fixed latency, so this measures
+how the engines schedule and overlap the calls, not vSphere itself.
+Every fake VM starts on the wrong port group and needs one reconfigure.
+Run it where neutron is installed, from the repository root:
+
+    python tools/benchmark_engines.py --ports 20 --latency 0.2
+"""
+
+
+import optparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from oslo.config import cfg
+
+from dvs import mechanism_dvs
+
+
+class FakeObject(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeTask(object):
+    def __init__(self, latency):
+        self.latency = latency
+
+    @property
+    def info(self):
+        time.sleep(self.latency)
+        return FakeObject(state='success', error=None)
+
+
+class FakeVM(object):
+    def __init__(self, latency):
+        self.latency = latency
+        port = FakeObject(portgroupKey='key-wrong')
+        self.nic = FakeObject(backing=FakeObject(port=port))
+
+    def Reconfigure(self, pg_name):
+        time.sleep(self.latency)
+        self.nic.backing.port.portgroupKey = 'key-' + pg_name
+        return FakeTask(self.latency)
+
+
+def fake_driver(engine, ports, latency, executors):
+    cfg.CONF.set_override('todo_engine', engine, 'ml2_dvs')
+    cfg.CONF.set_override('todo_executor_size', executors, 'ml2_dvs')
+    cfg.CONF.set_override('todo_initial_wait', 0, 'ml2_dvs')
+    # Room for every event of every port, "done" events are counted
+    # from the trace buffer and must not be pushed out of it.
+    cfg.CONF.set_override('trace_buffer_size', 20 * ports + 100, 'ml2_dvs')
+
+    driver = mechanism_dvs.VmwareDvswitchMechanismDriver()
+    vms = {}
+
+    def find_vm(name):
+        time.sleep(latency)
+        return vms.setdefault(name, FakeVM(latency))
+
+    def vm_nics(myvm):
+        time.sleep(latency)
+        return [myvm.nic]
+
+    driver._find_vm = find_vm
+    driver._vm_nics = vm_nics
+    driver._nic_config_spec = lambda nic, pg_name: pg_name
+    driver._check_si = lambda: driver
+    driver._check_dvs = lambda: driver
+    driver.warmup = threading.Thread(target=driver.ready.set)
+    driver.pg_key = {'bench': 'key-bench'}
+    return driver
+
+
+def run(engine, ports, latency, executors, timeout):
+    driver = fake_driver(engine, ports, latency, executors)
+    driver.initialize()
+    driver.warmup.join()
+
+    net = {'name': 'bench', 'provider:network_type': 'vlan'}
+    done = []
+    start = time.time()
+    for i in range(ports):
+        context = FakeObject(current={'device_id': 'vm-%d' % i},
+                             network=FakeObject(current=net))
+        driver.create_port_postcommit(context)
+
+    while time.time() < start + timeout:
+        done = [e for e in list(driver.trace.events) if e[2] == 'done']
+        if len(done) >= ports:
+            break
+        time.sleep(0.1)
+
+    # Guard the throughput division below
+    wall = max(max([e[0] for e in done] or [time.time()]) - start, 0.001)
+    durations = [e[4] for e in done]
+    print("%-9s %4d/%d ports done in %6.1f s, %5.2f ports/s,"
+          " enqueue-to-done mean %5.1f s max %5.1f s" %
+          (engine, len(done), ports, wall, len(done) / wall,
+           sum(durations) / max(len(durations), 1),
+           max(durations or [0])))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--ports', type='int', default=20,
+                      help='number of ports to connect')
+    parser.add_option('--latency', type='float', default=0.2,
+                      help='seconds per fake vSphere call')
+    parser.add_option('--executors', type='int', default=4,
+                      help='todo_executor_size for the pipeline engine')
+    parser.add_option('--timeout', type='int', default=300,
+                      help='seconds to wait for each engine')
+    parser.add_option('--engine', action='append',
+                      help='engine to run, may be repeated'
+                           ' (default: all)')
+    (options, args) = parser.parse_args()
+
+    cfg.CONF(args=[])
+    for engine in options.engine or mechanism_dvs.TODO_ENGINES:
+        run(engine, options.ports, options.latency, options.executors,
+            options.timeout)
+
+
+if __name__ == '__main__':
+    main()